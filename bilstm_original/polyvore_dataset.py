@@ -10,6 +10,8 @@ import gzip
 import json
 from PIL import Image
 import os
+from torchvision.io import decode_jpeg, read_file
+from torchvision.transforms import v2
 
 class PolyvoreDataset(Dataset):
     """ Polyvore Dataset."""
@@ -18,10 +20,12 @@ class PolyvoreDataset(Dataset):
     def __init__(self,
                  which_set='train',
                  root_dir='/export/home/wangx/datasets/polyvore-dataset/images/',
-                 transform=None):
+                 transform=None,
+                 gpu_decode=False):
 
         self.root_dir = root_dir
         self.transform = transform
+        self.gpu_decode = gpu_decode
         filename = '/export/home/wangx/datasets/polyvore-dataset/polyvore/{}_no_dup.json'.format(
             which_set)
 
@@ -52,14 +56,19 @@ class PolyvoreDataset(Dataset):
         for e in self.data[index]['items']:
             img_index = e['index']
             img_path = os.path.join(self.root_dir, str(set_id), str(img_index)) + '.jpg'
-            img = Image.open(img_path).convert('RGB')
-            img = self.transform(img)
-            images.append(img)
+            if self.gpu_decode:
+                # Raw JPEG bytes; decoded with nvJPEG on device at batch time
+                images.append(read_file(img_path))
+            else:
+                img = Image.open(img_path).convert('RGB')
+                img = self.transform(img)
+                images.append(img)
             image_ids.append('{}_{}'.format(set_id, img_index))
         #images.append(torch.ones_like(images[0])) # append an zero image as end-of-set
 
         input_images = images[:8]
-        input_images = torch.stack(input_images)
+        if not self.gpu_decode:
+            input_images = torch.stack(input_images)
 
         likes = self.data[index]['likes']
         desc = self.data[index]['desc']
@@ -85,7 +94,10 @@ def collate_fn(data):
     """Need custom a collate_fn for names and images"""
     data.sort(key=lambda x:x[0], reverse=True)
     lengths, names, likes, descs, images, image_ids = zip(*data)
-    images = torch.cat(images)
+    if isinstance(images[0], list):
+        images = sum(images, [])  # flat list of encoded JPEGs
+    else:
+        images = torch.cat(images)
     names = sum(names, [])
     return (
         lengths,
@@ -97,22 +109,114 @@ def collate_fn(data):
     )
 
 
+def make_gpu_transform(img_size=224):
+    """Resize/scale pipeline applied to uint8 CUDA tensors after
+    nvJPEG decode; matches the CPU Resize+ToTensor transform."""
+    return v2.Compose([
+        v2.Resize((img_size, img_size), antialias=True),
+        v2.ToDtype(torch.float32, scale=True),
+    ])
+
+
+def gpu_decode_batch(image_bytes, transform, device):
+    """Decode a list of encoded JPEGs with nvJPEG and transform them
+    on device, returning one stacked float tensor."""
+    images = decode_jpeg(image_bytes, device=device, mode=torchvision.io.ImageReadMode.RGB)
+    return torch.stack([transform(img) for img in images])
+
+
 def create_dataloader(batch_size=4,
                       shuffle=True,
                       num_workers=4,
                       which_set='train',
-                      img_size=224):
+                      img_size=224,
+                      pin_memory=False,
+                      persistent_workers=False,
+                      prefetch_factor=2,
+                      gpu_decode=False):
     transform = torchvision.transforms.Compose([
         torchvision.transforms.Resize((img_size, img_size)),
         torchvision.transforms.ToTensor()
     ])
     dataset = PolyvoreDataset(transform=transform,
-                              which_set=which_set)
+                              which_set=which_set,
+                              gpu_decode=gpu_decode)
+    return dataset, DataLoader(dataset,
+                               batch_size=batch_size,
+                               shuffle=shuffle,
+                               collate_fn=collate_fn,
+                               num_workers=num_workers,
+                               pin_memory=pin_memory,
+                               persistent_workers=persistent_workers,
+                               prefetch_factor=prefetch_factor)
+
+
+class PolyvoreFeatureDataset(Dataset):
+    """Polyvore Dataset backed by a precomputed encoder feature store.
+
+    Reads per-image embeddings from an fp16 memmap plus an image_id
+    index written at export time, so no image decoding or CNN forward
+    is needed. Batches look like PolyvoreDataset batches with features
+    in place of images.
+    """
+
+    def __init__(self,
+                 feature_file,
+                 which_set='train'):
+        filename = '/export/home/wangx/datasets/polyvore-dataset/polyvore/{}_no_dup.json'.format(
+            which_set)
+
+        with open(filename) as f:
+            self.data = json.load(f)
+
+        with open(feature_file + '.index.json') as f:
+            self.id_to_row = json.load(f)
+        features = np.memmap(feature_file, dtype=np.float16, mode='r')
+        self.features = features.reshape(len(self.id_to_row), -1)
+
+    def __getitem__(self, index):
+        set_id = self.data[index]['set_id']
+        image_ids = []
+        for e in self.data[index]['items']:
+            image_ids.append('{}_{}'.format(set_id, e['index']))
+
+        rows = [self.id_to_row[i] for i in image_ids[:8]]
+        feats = torch.from_numpy(np.array(self.features[rows]))
+
+        likes = self.data[index]['likes']
+        desc = self.data[index]['desc']
+
+        return (
+            len(image_ids),   # lengths
+            [],               # names (unused on the cached path)
+            likes,            # likes
+            desc,             # desc
+            feats,            # features instead of images
+            image_ids,        # image_ids
+        )
+
+    def __len__(self):
+        return len(self.data)
+
+
+def create_feature_dataloader(feature_file,
+                              batch_size=4,
+                              shuffle=True,
+                              num_workers=4,
+                              which_set='train',
+                              pin_memory=False,
+                              persistent_workers=False,
+                              prefetch_factor=2):
+    dataset = PolyvoreFeatureDataset(feature_file,
+                                     which_set=which_set)
     return dataset, DataLoader(dataset,
                                batch_size=batch_size,
                                shuffle=shuffle,
                                collate_fn=collate_fn,
-                               num_workers=num_workers)
+                               num_workers=num_workers,
+                               pin_memory=pin_memory,
+                               persistent_workers=persistent_workers,
+                               prefetch_factor=prefetch_factor)
 
 
 class PredictCompatibilityDataset(Dataset):
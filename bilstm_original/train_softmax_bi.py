@@ -1,16 +1,26 @@
 import argparse
+import json
 import logging
 import numpy as np
 import os
 import sys
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import torch.nn.utils.rnn as rnn_utils
 import torchvision
 from model import EncoderCNN, LSTMModel
-from polyvore_dataset import create_dataloader
+from torch.cuda.amp import autocast
+from torch.utils.checkpoint import checkpoint
+from polyvore_dataset import (
+    create_dataloader,
+    create_feature_dataloader,
+    gpu_decode_batch,
+    make_gpu_transform,
+)
 from torch.optim import lr_scheduler
 from torch.utils.data import DataLoader
+from concurrent.futures import ThreadPoolExecutor
 
 ################################# Argparse ####################################
 parser = argparse.ArgumentParser(description="Polyvore BiLSTM")
@@ -18,6 +28,12 @@ parser.add_argument("--model", type=str, default="lstm")
 parser.add_argument("--epochs", type=int, default=30)
 parser.add_argument("--batch_size", type=int, default=16)
 parser.add_argument("--comment", type=str, default="")
+parser.add_argument("--gpu_decode", action="store_true",
+                    help="decode JPEGs on GPU with nvJPEG instead of "
+                         "PIL in the loader workers")
+parser.add_argument("--freeze_encoder_epochs", type=int, default=0,
+                    help="after this many epochs freeze the encoder and "
+                         "train from cached features (0 disables)")
 args = parser.parse_args()
 print(args)
 
@@ -31,29 +47,56 @@ emb_size = 512
 log_step = 50
 device = torch.device("cuda")
 
+# TF32 matmul/conv on Ampere+; benchmark mode is safe since img_size is fixed
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
+torch.backends.cudnn.benchmark = True
+torch.backends.cudnn.deterministic = False
+torch.set_float32_matmul_precision("high")
+
 ################################# DataLoader ##################################
 img_size = 299
+# Workers persist across epochs, so size the pool to the host; with
+# this many workers a prefetch_factor of 2 is plenty and keeps pinned
+# host memory bounded
+num_workers = min(os.cpu_count() or 4, 16)
+
+# On the gpu_decode path the loader ships encoded JPEG bytes and this
+# pipeline resizes/scales the nvJPEG output on device
+GPU_TRANSFORM = make_gpu_transform(img_size) if args.gpu_decode else None
 
 train_dataset, train_loader = create_dataloader(
     batch_size=batch_size,
     shuffle=True,
-    num_workers=4,
+    num_workers=num_workers,
     which_set="train",
     img_size=img_size,
+    pin_memory=True,
+    persistent_workers=True,
+    prefetch_factor=2,
+    gpu_decode=args.gpu_decode,
 )
 _, val_loader = create_dataloader(
     batch_size=batch_size,
     shuffle=False,
-    num_workers=4,
+    num_workers=num_workers,
     which_set="valid",
     img_size=img_size,
+    pin_memory=True,
+    persistent_workers=True,
+    prefetch_factor=2,
+    gpu_decode=args.gpu_decode,
 )
 _, test_loader = create_dataloader(
     batch_size=batch_size,
     shuffle=False,
-    num_workers=4,
+    num_workers=num_workers,
     which_set="test",
     img_size=img_size,
+    pin_memory=True,
+    persistent_workers=True,
+    prefetch_factor=2,
+    gpu_decode=args.gpu_decode,
 )
 
 ###############################################################################
@@ -67,11 +110,17 @@ if model == "lstm":
 f_rnn = f_rnn.to(device)
 b_rnn = b_rnn.to(device)
 
+# Compile to fuse pointwise ops and cut kernel-launch overhead;
+# dynamic=True avoids recompiles across variable sequence lengths
+encoder_cnn = torch.compile(encoder_cnn, mode="reduce-overhead", dynamic=True)
+f_rnn = torch.compile(f_rnn, mode="reduce-overhead", dynamic=True)
+b_rnn = torch.compile(b_rnn, mode="reduce-overhead", dynamic=True)
+
 criterion = nn.CrossEntropyLoss()
 params_to_train = (
     list(encoder_cnn.parameters()) + list(f_rnn.parameters()) + list(b_rnn.parameters())
 )
-optimizer = torch.optim.SGD(params_to_train, lr=2e-1, momentum=0.9)
+optimizer = torch.optim.SGD(params_to_train, lr=2e-1, momentum=0.9, foreach=True)
 scheduler = lr_scheduler.StepLR(optimizer, step_size=2, gamma=0.5)
 
 ################################## Logger #####################################
@@ -91,78 +140,265 @@ logger.addHandler(stream_handler)
 logger.addHandler(file_handler)
 
 ################################## Train ######################################
-def flip_tensor(tensor, device=device):
-    """Flip a tensor in 0 dim for backward rnn.
+# Reused CE targets (0..N-1); sliced per batch instead of a fresh
+# torch.arange H2D copy every step
+ARANGE_CACHE = torch.arange(4096, device=device)
+
+
+class CUDAPrefetcher:
+    """Prefetch the next batch's images to GPU on a side CUDA stream.
+
+    While the current batch is training on the default stream, the next
+    image tensor is copied host-to-device on a dedicated stream so the
+    PCIe transfer overlaps compute (same recipe as apex data_prefetcher).
+    """
+
+    def __init__(self, loader, device=device, transform=None):
+        self.loader_iter = iter(loader)
+        self.device = device
+        self.transform = transform
+        self.stream = torch.cuda.Stream()
+        self.preload()
+
+    def preload(self):
+        try:
+            input_data = next(self.loader_iter)
+        except StopIteration:
+            self.next_data = None
+            return
+        lengths, names, likes, descs, images, image_ids = input_data
+        with torch.cuda.stream(self.stream):
+            if isinstance(images, list):
+                images = gpu_decode_batch(images, self.transform, self.device)
+            else:
+                images = images.to(self.device, non_blocking=True)
+        self.next_data = (lengths, names, likes, descs, images, image_ids)
+
+    def next(self):
+        if self.next_data is None:
+            return None
+        torch.cuda.current_stream().wait_stream(self.stream)
+        input_data = self.next_data
+        input_data[4].record_stream(torch.cuda.current_stream())
+        self.preload()
+        return input_data
+
+
+def build_slice_indices(lengths, device=device):
+    """Flat indices of the first length-1 items of each sequence.
+
+    With outfits concatenated in emb_seqs, index_select with these
+    indices yields all input embeddings in one gather; the same indices
+    shifted by one yield all target embeddings.
+    """
+    lengths_t = torch.as_tensor(lengths)
+    in_lengths = lengths_t - 1
+    starts = lengths_t.cumsum(0) - lengths_t
+    in_starts = in_lengths.cumsum(0) - in_lengths
+    seq_of = torch.repeat_interleave(torch.arange(len(lengths)), in_lengths)
+    offsets = torch.arange(int(in_lengths.sum())) - in_starts[seq_of]
+    return (starts[seq_of] + offsets).to(device, non_blocking=True)
+
+
+def build_pad_indices(in_lengths, device=device):
+    """(B, Lmax) indices into the flat gathered embeddings plus the
+    padding mask, forward and reversed.
+
+    Padding one sequence per pad_sequence entry launches a copy kernel
+    each; indexing the flat tensor with these matrices pads a whole
+    batch in a single gather. Everything ships to the GPU in one copy.
+    """
+    in_lengths_t = torch.as_tensor(in_lengths)
+    max_len = int(in_lengths_t.max())
+    in_starts = in_lengths_t.cumsum(0) - in_lengths_t
+    pos = torch.arange(max_len).expand(len(in_lengths), max_len)
+    mask = pos < in_lengths_t[:, None]
+    fwd = (in_starts[:, None] + pos).clamp_max(int(in_lengths_t.sum()) - 1)
+    rev = (in_starts[:, None] + in_lengths_t[:, None] - 1 - pos).clamp_min(0)
+    stacked = torch.stack((fwd, rev, mask.long())).to(device, non_blocking=True)
+    return stacked[0], stacked[1], stacked[2].bool()
+
+
+def build_rnn_batch(emb_seqs, lengths):
+    """Build the forward/backward rnn inputs and packed targets.
+
+    Input and target embeddings come from one gather each over the
+    concatenated batch; the same tensors feed both directions, so
+    nothing is sliced or flipped twice.
+    """
+    in_lengths = [i - 1 for i in lengths]
+    input_idx = build_slice_indices(lengths)
+    input_flat = emb_seqs.index_select(0, input_idx)
+    target_flat = emb_seqs.index_select(0, input_idx + 1)
+
+    fwd_idx, rev_idx, mask = build_pad_indices(in_lengths)
+    pad_mask = mask.unsqueeze(-1)
+    zero = input_flat.new_zeros(())
+    f_input_embs = torch.where(pad_mask, input_flat[fwd_idx], zero)  # (4, 7, 512) (1, 2, 3, 4)
+    b_target_embs = torch.where(pad_mask, input_flat[rev_idx], zero)  # (4, 3, 2, 1)
+    f_target_embs = torch.where(pad_mask, target_flat[fwd_idx], zero)  # (2, 3, 4, 5)
+    b_input_embs = torch.where(pad_mask, target_flat[rev_idx], zero)  # (5, 4, 3, 2)
+
+    # Flatten the targets in packed (time-major) order with one mask
+    # gather each instead of two pack_padded_sequence calls. The
+    # ordering matches the rnns' packed output because collate_fn sorts
+    # outfits by descending length.
+    tmask = mask.t()
+    f_target_embs = f_target_embs.transpose(0, 1)[tmask]
+    b_target_embs = b_target_embs.transpose(0, 1)[tmask]
+
+    seq_lengths = torch.as_tensor(lengths, dtype=torch.long) - 1  # CPU lengths for pack_padded_sequence in the rnns
+    return f_input_embs, b_input_embs, f_target_embs, b_target_embs, seq_lengths
+
+
+def images_to_device(images):
+    """Move an image batch to GPU, decoding with nvJPEG on the
+    gpu_decode path."""
+    if isinstance(images, list):
+        return gpu_decode_batch(images, GPU_TRANSFORM, device)
+    return images.to(device, non_blocking=True)
+
+
+def export_feature_store(loader, path):
+    """Run the frozen encoder once over the dataset and cache fp16
+    features to an mmap'd file, indexed by image_id."""
+    encoder_cnn.train(False)
+    ids, feats = [], []
+    for input_data in loader:
+        lengths, names, likes, descs, images, image_ids = input_data
+        with torch.no_grad(), autocast(dtype=torch.bfloat16):
+            emb_seqs = encoder_cnn(images_to_device(images))
+        feats.append(emb_seqs.float().to(torch.float16).cpu().numpy())
+        for outfit in image_ids:
+            ids.extend(outfit)
+    feats = np.concatenate(feats)
+    store = np.memmap(path, dtype=np.float16, mode="w+", shape=feats.shape)
+    store[:] = feats
+    store.flush()
+    with open(path + ".index.json", "w") as f:
+        json.dump({id: row for row, id in enumerate(ids)}, f)
+
+
+def contrastive_ce(output, targets, chunk_size=1024):
+    """In-batch softmax CE where position i's positive is targets[i].
+
+    Equivalent to criterion(output @ targets.t(), arange(N)), but for
+    large N the score matrix is computed in row chunks so only a
+    (chunk, N) block is live in the autograd graph at a time, keeping
+    peak activation memory O(N*chunk) instead of O(N^2).
     """
-    idx = [i for i in range(tensor.size(0) - 1, -1, -1)]
-    idx = torch.LongTensor(idx).to(device)
-    flipped_tensor = tensor.index_select(0, idx)
-    return flipped_tensor
+    n = output.shape[0]
+    if n <= chunk_size:
+        return criterion(F.linear(output, targets), ARANGE_CACHE[:n])
+    loss = output.new_zeros(())
+    for start in range(0, n, chunk_size):
+        chunk = output[start : start + chunk_size]
+        scores = F.linear(chunk, targets)  # (chunk, N)
+        labels = ARANGE_CACHE[start : start + chunk.shape[0]]
+        loss = loss + F.cross_entropy(scores, labels, reduction="sum")
+    return loss / n
+
+
+CKPT_EXECUTOR = ThreadPoolExecutor(max_workers=1)
+
+
+def save_checkpoints_async(prev_future):
+    """Snapshot state_dicts to CPU and pickle them on a worker thread
+    so the epoch boundary is not blocked on checkpoint I/O."""
+    if prev_future is not None:
+        prev_future.result()  # never queue behind an unfinished save
+    snapshots = []
+    for m, path in (
+        (f_rnn, "f_rnn{}.pth".format(comment)),
+        (b_rnn, "b_rnn{}.pth".format(comment)),
+        (encoder_cnn, "encoder_cnn{}.pth".format(comment)),
+    ):
+        state = {
+            k: v.detach().to("cpu", non_blocking=True)
+            for k, v in m._orig_mod.state_dict().items()
+        }
+        snapshots.append((state, path))
+    torch.cuda.synchronize()  # D2H copies must land before pickling
+
+    def write():
+        for state, path in snapshots:
+            torch.save(state, path)
+
+    return CKPT_EXECUTOR.submit(write)
 
 
 def train():
+    feature_file = "train_features{}.fp16".format(comment)
+    feat_train_loader = None
+    ckpt_future = None
     for epoch in range(1, epochs + 1):
         # Train phase
-        total_loss = 0
+        total_loss = torch.zeros((), device=device)
         scheduler.step()
         encoder_cnn.train(True)
         f_rnn.train(True)
         b_rnn.train(True)
-        for batch_num, input_data in enumerate(train_loader, 1):
+
+        # After the warm-up epochs, freeze the encoder, cache its
+        # features once and train the rnns from the feature store
+        use_cached = args.freeze_encoder_epochs and epoch > args.freeze_encoder_epochs
+        if use_cached and feat_train_loader is None:
+            logger.info("Freezing encoder, caching features to {}".format(feature_file))
+            export_feature_store(train_loader, feature_file)
+            for p in encoder_cnn.parameters():
+                p.requires_grad_(False)
+            _, feat_train_loader = create_feature_dataloader(
+                feature_file,
+                batch_size=batch_size,
+                shuffle=True,
+                num_workers=num_workers,
+                which_set="train",
+                pin_memory=True,
+                persistent_workers=True,
+                prefetch_factor=2,
+            )
+
+        prefetcher = CUDAPrefetcher(
+            feat_train_loader if use_cached else train_loader,
+            transform=GPU_TRANSFORM,
+        )
+        batch_num = 0
+        input_data = prefetcher.next()
+        while input_data is not None:
+            batch_num += 1
             lengths, names, likes, descs, images, image_ids = input_data
-            image_seqs = images.to(device)  # (20+, 3, 224, 224)
-            emb_seqs = encoder_cnn(image_seqs)  # (20+, 512)
-
-            # Generate input embeddings e.g. (1, 2, 3, 4)
-            input_emb_list = []
-            start = 0
-            for length in lengths:
-                input_emb_list.append(emb_seqs[start : start + length - 1])
-                start += length
-            f_input_embs = rnn_utils.pad_sequence(
-                input_emb_list, batch_first=True
-            )  # (4, 7, 512) (1, 2, 3, 4)
-            b_target_embs = rnn_utils.pad_sequence(
-                [flip_tensor(e) for e in input_emb_list], batch_first=True
-            )  # (4, 3, 2, 1)
-
-            # Generate target embeddings e.g. (2, 3, 4, 5)
-            target_emb_list = []
-            start = 0
-            for length in lengths:
-                target_emb_list.append(emb_seqs[start + 1 : start + length])
-                start += length
-            f_target_embs = rnn_utils.pad_sequence(
-                target_emb_list, batch_first=True
-            )  # (2, 3, 4, 5)
-            b_input_embs = rnn_utils.pad_sequence(
-                [flip_tensor(e) for e in target_emb_list], batch_first=True
-            )  # (5, 4, 3, 2)
-
-            seq_lengths = torch.tensor([i - 1 for i in lengths]).to(device)
-            f_target_embs = rnn_utils.pack_padded_sequence(
-                f_target_embs, seq_lengths, batch_first=True
-            )[0]
-            b_target_embs = rnn_utils.pack_padded_sequence(
-                b_target_embs, seq_lengths, batch_first=True
-            )[0]
-
-            f_output = f_rnn(f_input_embs, seq_lengths)
-            f_score = torch.matmul(f_output, f_target_embs.t())
-            f_loss = criterion(f_score, torch.arange(f_score.shape[0]).to(device))
-            b_output = b_rnn(b_input_embs, seq_lengths)
-            b_score = torch.matmul(b_output, b_target_embs.t())
-            b_loss = criterion(b_score, torch.arange(b_score.shape[0]).to(device))
-            all_loss = f_loss + b_loss
-
-            encoder_cnn.zero_grad()
-            f_rnn.zero_grad()
-            b_rnn.zero_grad()
+            image_seqs = images  # already on device (20+, 3, 224, 224)
+            # BF16 autocast for forward/loss; master weights stay fp32
+            with autocast(dtype=torch.bfloat16):
+                if use_cached:
+                    emb_seqs = image_seqs.float()  # cached fp16 features
+                else:
+                    # Checkpoint the encoder: recompute its activations
+                    # in backward instead of keeping them, freeing
+                    # memory for larger batches
+                    emb_seqs = checkpoint(
+                        encoder_cnn, image_seqs, use_reentrant=False
+                    )  # (20+, 512)
+                (
+                    f_input_embs,
+                    b_input_embs,
+                    f_target_embs,
+                    b_target_embs,
+                    seq_lengths,
+                ) = build_rnn_batch(emb_seqs, lengths)
+
+                f_output = f_rnn(f_input_embs, seq_lengths)
+                f_loss = contrastive_ce(f_output, f_target_embs)
+                b_output = b_rnn(b_input_embs, seq_lengths)
+                b_loss = contrastive_ce(b_output, b_target_embs)
+                all_loss = f_loss + b_loss
+
+            optimizer.zero_grad(set_to_none=True)
             all_loss.backward()
             nn.utils.clip_grad_norm_(params_to_train, 0.5)  # clip gradient
             optimizer.step()
 
-            total_loss += all_loss.item()
+            total_loss += all_loss.detach()
             # Print log info
             if batch_num % log_step == 0:
                 logger.info(
@@ -176,81 +412,47 @@ def train():
                     )
                 )
 
+            input_data = prefetcher.next()
+
         logger.info(
-            "**Epoch {}**, Train Loss {:.4f}".format(epoch, total_loss / batch_num)
-        )
-        # Save the model checkpoints
-        torch.save(
-            f_rnn.state_dict(), os.path.join("f_rnn{}.pth".format(comment))
-        )
-        torch.save(
-            b_rnn.state_dict(), os.path.join("b_rnn{}.pth".format(comment))
-        )
-        torch.save(
-            encoder_cnn.state_dict(),
-            os.path.join("encoder_cnn{}.pth".format(comment)),
+            "**Epoch {}**, Train Loss {:.4f}".format(epoch, total_loss.item() / batch_num)
         )
+        # Save the model checkpoints off-thread
+        ckpt_future = save_checkpoints_async(ckpt_future)
 
         # Validate phase !!!
         encoder_cnn.train(False)  # eval mode (batchnorm uses moving mean/variance
         f_rnn.train(False)  # eval mode (batchnorm uses moving mean/variance
         b_rnn.train(False)  # eval mode (batchnorm uses moving mean/variance
-        total_loss = 0
+        total_loss = torch.zeros((), device=device)
         for batch_num, input_data in enumerate(val_loader, 1):
             lengths, names, likes, descs, images, image_ids = input_data
-            image_seqs = images.to(device)  # (20+, 3, 224, 224)
-            with torch.no_grad():
+            image_seqs = images_to_device(images)  # (20+, 3, 224, 224)
+            with torch.no_grad(), autocast(dtype=torch.bfloat16):
                 emb_seqs = encoder_cnn(image_seqs)  # (20+, 512)
+                (
+                    f_input_embs,
+                    b_input_embs,
+                    f_target_embs,
+                    b_target_embs,
+                    seq_lengths,
+                ) = build_rnn_batch(emb_seqs, lengths)
 
-            # Generate input embeddings e.g. (1, 2, 3, 4)
-            input_emb_list = []
-            start = 0
-            for length in lengths:
-                input_emb_list.append(emb_seqs[start : start + length - 1])
-                start += length
-            f_input_embs = rnn_utils.pad_sequence(
-                input_emb_list, batch_first=True
-            )  # (4, 7, 512) (1, 2, 3, 4)
-            b_target_embs = rnn_utils.pad_sequence(
-                [flip_tensor(e) for e in input_emb_list], batch_first=True
-            )  # (4, 3, 2, 1)
-
-            # Generate target embeddings e.g. (2, 3, 4, 5)
-            target_emb_list = []
-            start = 0
-            for length in lengths:
-                target_emb_list.append(emb_seqs[start + 1 : start + length])
-                start += length
-            f_target_embs = rnn_utils.pad_sequence(
-                target_emb_list, batch_first=True
-            )  # (2, 3, 4, 5)
-            b_input_embs = rnn_utils.pad_sequence(
-                [flip_tensor(e) for e in target_emb_list], batch_first=True
-            )  # (5, 4, 3, 2)
-
-            seq_lengths = torch.tensor([i - 1 for i in lengths]).to(device)
-            f_target_embs = rnn_utils.pack_padded_sequence(
-                f_target_embs, seq_lengths, batch_first=True
-            )[0]
-            b_target_embs = rnn_utils.pack_padded_sequence(
-                b_target_embs, seq_lengths, batch_first=True
-            )[0]
-
-            with torch.no_grad():
                 f_output = f_rnn(f_input_embs, seq_lengths)
-                f_score = torch.matmul(f_output, f_target_embs.t())
-                f_loss = criterion(f_score, torch.arange(f_score.shape[0]).to(device))
+                f_loss = contrastive_ce(f_output, f_target_embs)
                 b_output = b_rnn(b_input_embs, seq_lengths)
-                b_score = torch.matmul(b_output, b_target_embs.t())
-                b_loss = criterion(b_score, torch.arange(b_score.shape[0]).to(device))
+                b_loss = contrastive_ce(b_output, b_target_embs)
                 all_loss = f_loss + b_loss
 
-            total_loss += all_loss.item()
+            total_loss += all_loss.detach()
 
         logger.info(
-            "**Epoch {}**, Valid Loss {:.4f}".format(epoch, total_loss / batch_num)
+            "**Epoch {}**, Valid Loss {:.4f}".format(epoch, total_loss.item() / batch_num)
         )
 
+    if ckpt_future is not None:
+        ckpt_future.result()
+
 
 if __name__ == "__main__":
     train()